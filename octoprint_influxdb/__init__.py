@@ -1,15 +1,19 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import collections
+import logging
 import platform
+import random
 import socket
-import datetime
 import sys
+import threading
+import time
 
 import octoprint.plugin
 import octoprint.util
 import influxdb
-import monotonic
+import requests
 
 # control properties
 __plugin_name__ = "InfluxDB Plugin"
@@ -20,11 +24,84 @@ ALLOWED_TYPES = (str, float, int, bool)
 if sys.version_info < (3, 0):
 	ALLOWED_TYPES = (unicode,) + ALLOWED_TYPES
 
+# monotonic clock, which python 2 doesn't have
+if sys.version_info < (3, 3):
+	from monotonic import monotonic
+else:
+	from time import monotonic
+
+# current time in integer nanoseconds
+if hasattr(time, 'time_ns'):
+	time_ns = time.time_ns
+else:
+	def time_ns():
+		return int(time.time() * 1e9)
+
 # host methods
 HOST_NODE = "node"
 HOST_FQDN = "fqdn"
 HOST_CUSTOM = "custom"
 
+# default settings
+SETTINGS_DEFAULTS = dict(
+	host=None,
+	port=None,
+	authenticate=False,
+	udp=False,
+	ssl=False,
+	verify_ssl=True,
+	database='octoprint',
+	prefix='',
+	hostmethod=HOST_NODE,
+	hostcustom='octoprint',
+	username=None,
+	password=None,
+	retention_policy=None,
+	interval=1,
+	batch_size=100,
+	flush_interval=5,
+	max_idle_interval=30,
+)
+
+# most points to hold onto while the database is unreachable
+MAX_PENDING = 10000
+# most points to send to the database in a single request
+MAX_WRITE_BATCH = 5000
+# most HTTP connections to keep open to the database
+HTTP_POOL_SIZE = 4
+# seconds to wait on the database before giving up on a request
+HTTP_TIMEOUT = 10
+# longest we're willing to hold up OctoPrint's shutdown, in seconds
+SHUTDOWN_FLUSH_TIMEOUT = 5
+# how many steady temperature samples before we slow down gathering
+IDLE_SAMPLES = 3
+# how far temperatures can drift and still be steady, in degrees
+IDLE_TOLERANCE = 0.5
+# longest time to wait between reconnect attempts, in seconds
+MAX_RECONNECT_DELAY = 300
+# seconds to wait for settings to stop changing before reconnecting
+SETTINGS_DEBOUNCE = 0.5
+# largest UDP packet to send, small enough to avoid fragmentation
+UDP_PACKET_SIZE = 1400
+
+# line protocol escaping, same as influxdb.line_protocol does it
+def line_escape_name(s):
+	return s.replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=').replace('\n', '\\n')
+
+def line_escape_measurement(s):
+	return s.replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('\n', '\\n')
+
+def line_format_value(v):
+	# bool first, since bools are also ints
+	if isinstance(v, bool):
+		return 'true' if v else 'false'
+	elif isinstance(v, int):
+		return '{}i'.format(v)
+	elif isinstance(v, float):
+		return repr(v)
+	else:
+		return '"' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
 def __plugin_load__():
 	global __plugin_implementation__
 	__plugin_implementation__ = InfluxDBPlugin()
@@ -37,6 +114,7 @@ def __plugin_load__():
 class InfluxDBPlugin(octoprint.plugin.EventHandlerPlugin,
                      octoprint.plugin.RestartNeedingPlugin, # see issue #14
                      octoprint.plugin.SettingsPlugin,
+                     octoprint.plugin.ShutdownPlugin,
                      octoprint.plugin.StartupPlugin,
                      octoprint.plugin.TemplatePlugin):
 
@@ -44,9 +122,27 @@ class InfluxDBPlugin(octoprint.plugin.EventHandlerPlugin,
 
 	def __init__(self):
 		self.influx_timer = None
+		self.influx_flush_timer = None
 		self.influx_db = None
 		self.influx_last_reconnect = None
+		self.influx_reconnect_delay = 0
+		self.influx_reconnect_failures = 0
+		self.influx_retry_timer = None
+		self.influx_shutting_down = False
+		# (host, port, username, database) we've seen exist already
+		self.influx_known_dbs = set()
 		self.influx_kwargs = None
+		self.influx_settings_hash_last = None
+		self.influx_timers_for = None
+		self.influx_interval = None
+		self.influx_gather_interval = None
+		self.influx_recent_temps = collections.deque(maxlen=IDLE_SAMPLES)
+		self.influx_settings_timer = None
+		self.influx_use_udp = False
+		self.influx_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.influx_pending = collections.deque(maxlen=MAX_PENDING)
+		self.influx_pending_lock = threading.Lock()
+		self.influx_last_flush = monotonic()
 
 	@property
 	def influx_common_tags(self):
@@ -78,28 +174,42 @@ class InfluxDBPlugin(octoprint.plugin.EventHandlerPlugin,
 		# FIXME flash something to the user, probably needs JS
 
 	def influx_try_connect(self, kwargs):
-		# create a safe copy we can dump out to the log, modify fields
-		kwargs = kwargs.copy()
-		kwargs_safe = kwargs.copy()
-		for k in ['username', 'password']:
-			if k in kwargs_safe:
-				del kwargs_safe[k]
-		kwargs_log = ", ".join("{}={!r}".format(*v) for v in sorted(kwargs_safe.items()))
-		self._logger.info("connecting: {}".format(kwargs_log))
-
-		dbname = 'octoprint'
-		if 'database' in kwargs:
-			dbname = kwargs.pop('database')
+		if self._logger.isEnabledFor(logging.INFO):
+			# create a safe copy we can dump out to the log
+			kwargs_safe = {k: v for k, v in kwargs.items() if k not in ('username', 'password')}
+			kwargs_log = ", ".join("{}={!r}".format(*v) for v in sorted(kwargs_safe.items()))
+			self._logger.info("connecting: %s", kwargs_log)
+
+		# the client is happy to take the database too, but we still
+		# need to check that it exists before switching to it
+		dbname = kwargs.get('database', 'octoprint')
+		db_key = self.influx_db_key(kwargs)
+
+		# one persistent, keep-alive session for every write, so we don't
+		# pay for a new TCP (and TLS) handshake each time
+		session = requests.Session()
+		session.headers['Connection'] = 'keep-alive'
 
 		try:
-			db = influxdb.InfluxDBClient(**kwargs)
-			db.ping()
+			db = influxdb.InfluxDBClient(session=session, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT, gzip=True, **kwargs)
+			if db_key in self.influx_known_dbs:
+				# we already know this database exists, and if it has gone
+				# away since, writes will notice and we'll end up back here
+				db.ping()
+				databases = None
+			else:
+				# this also tells us the server is there, no need to ping
+				databases = db.get_list_database()
 		except Exception:
 			# something went wrong connecting :(
 			self.influx_flash_exception('Cannot connect to InfluxDB server.')
+			session.close()
 			return None
+		if databases is None:
+			db.switch_database(dbname)
+			return db
 		try:
-			for dbmeta in db.get_list_database():
+			for dbmeta in databases:
 				if dbmeta['name'] == dbname:
 					# database exists, do not create
 					self._logger.info('Using existing database `{0}`'.format(dbname))
@@ -110,29 +220,26 @@ class InfluxDBPlugin(octoprint.plugin.EventHandlerPlugin,
 				db.create_database(dbname)
 			# ok, now switch to the database
 			db.switch_database(dbname)
+			self.influx_known_dbs.add(db_key)
 		except Exception:
 			# something went wrong making the database
 			self.influx_flash_exception('Cannot create InfluxDB database.')
+			db.close()
 			return None
 		return db
 
+	def influx_db_key(self, kwargs):
+		# ping doesn't need credentials, so a known database only counts
+		# for the user that saw it
+		return (kwargs.get('host'), kwargs.get('port'), kwargs.get('username'), kwargs.get('database', 'octoprint'))
+
 	def influx_connected(self):
 		if self.influx_db:
 			return True
 		self.influx_reconnect()
 		return bool(self.influx_db)
 
-	def influx_reconnect(self, force=False):
-		now = monotonic.monotonic()
-		if not (force or self.influx_last_reconnect is None or self.influx_last_reconnect + 10 < now):
-			# don't attempt to reconnect more than once per 10s
-			return
-		self.influx_last_reconnect = now
-		# stop the old timer, if we need to
-		if self.influx_timer:
-			self.influx_timer.cancel()
-			self.influx_timer = None
-
+	def influx_build_kwargs(self):
 		# build up some kwargs to pass to InfluxDBClient
 		kwargs = {}
 		def add_arg_if_exists(kwargsname, path, getter=self._settings.get):
@@ -153,154 +260,413 @@ class InfluxDBPlugin(octoprint.plugin.EventHandlerPlugin,
 		if kwargs['use_udp'] and 'port' in kwargs:
 			kwargs['udp_port'] = kwargs['port']
 			del kwargs['port']
+		return kwargs
+
+	def influx_settings_hash(self, kwargs):
+		# everything that is only read when we connect
+		return hash((
+			tuple(sorted(kwargs.items())),
+			self._settings.get(['prefix']),
+			self._settings.get(['retention_policy']),
+			self._settings.get(['hostmethod']),
+			self._settings.get(['hostcustom']),
+		))
+
+	def influx_timer_settings(self):
+		interval = self._settings.get_float(['interval'], min=0)
+		if not interval:
+			interval = SETTINGS_DEFAULTS['interval']
+		batch_size = self._settings.get_int(['batch_size'], min=1)
+		if not batch_size:
+			batch_size = SETTINGS_DEFAULTS['batch_size']
+		flush_interval = self._settings.get_float(['flush_interval'], min=0)
+		if not flush_interval:
+			flush_interval = SETTINGS_DEFAULTS['flush_interval']
+		max_idle_interval = self._settings.get_float(['max_idle_interval'], min=0)
+		if not max_idle_interval:
+			max_idle_interval = SETTINGS_DEFAULTS['max_idle_interval']
+		return (interval, batch_size, flush_interval, max_idle_interval)
+
+	def influx_stop_timers(self):
+		if self.influx_timer:
+			self.influx_timer.cancel()
+			self.influx_timer = None
+		if self.influx_flush_timer:
+			self.influx_flush_timer.cancel()
+			self.influx_flush_timer = None
+
+	def influx_start_timers(self):
+		self.influx_stop_timers()
+		self.influx_timers_for = self.influx_timer_settings()
+		self.influx_interval, self.influx_batch_size, self.influx_flush_interval, self.influx_max_idle_interval = self.influx_timers_for
+		self.influx_gather_interval = self.influx_interval
+		self.influx_recent_temps.clear()
+
+		# the timer asks for the interval each time, so it can change
+		self.influx_timer = octoprint.util.RepeatedTimer(lambda: self.influx_gather_interval, self.influx_gather)
+		self.influx_timer.start()
+		self.influx_flush_timer = octoprint.util.RepeatedTimer(self.influx_flush_interval, self._flush_pending)
+		self.influx_flush_timer.start()
 
-		if self.influx_db is None or kwargs != self.influx_kwargs:
+	def influx_reconnect(self, force=False):
+		if self.influx_shutting_down:
+			return
+		now = monotonic()
+		if not (force or self.influx_last_reconnect is None or self.influx_last_reconnect + self.influx_reconnect_delay < now):
+			# back off while the server is unreachable
+			return
+		self.influx_last_reconnect = now
+		# this attempt replaces any retry we had scheduled
+		if self.influx_retry_timer:
+			self.influx_retry_timer.cancel()
+			self.influx_retry_timer = None
+		# stop the old timers, if we need to
+		self.influx_stop_timers()
+
+		kwargs = self.influx_build_kwargs()
+		settings_hash = self.influx_settings_hash(kwargs)
+
+		if self.influx_db is None or settings_hash != self.influx_settings_hash_last:
+			if settings_hash != self.influx_settings_hash_last:
+				# new settings, so past failures don't count
+				self.influx_reconnect_failures = 0
+				self.influx_reconnect_delay = 0
+			if self.influx_db:
+				self.influx_db.close()
 			self.influx_db = self.influx_try_connect(kwargs)
+			# failures are only forgotten once a write succeeds, since
+			# a server can answer pings and still fail every write
 			if self.influx_db:
 				self.influx_kwargs = kwargs
+				self.influx_settings_hash_last = settings_hash
 				self.influx_prefix = self._settings.get(['prefix']) or ''
 				self.influx_retention_policy = self._settings.get(['retention_policy']) or None
-
-		# start a new timer
-		if self.influx_db:
-			interval = self._settings.get_float(['interval'], min=0)
-			if not interval:
-				interval = self.get_settings_defaults()['interval']
-			self.influx_timer = octoprint.util.RepeatedTimer(interval, self.influx_gather)
-			self.influx_timer.start()
+				# common tags don't change, so sanitize them only once
+				self.influx_safe_common_tags = self.influx_sanitize_names(self.influx_common_tags)
+
+				if kwargs['use_udp'] != self.influx_use_udp:
+					# buffered points are in the wrong format now
+					with self.influx_pending_lock:
+						self.influx_pending.clear()
+				self.influx_use_udp = kwargs['use_udp']
+				if self.influx_use_udp:
+					self.influx_udp_address = (kwargs.get('host', 'localhost'), kwargs.get('udp_port', 4444))
+					# ...or escape them
+					self.influx_line_tags = ''.join(
+						',' + line_escape_name(k) + '=' + line_escape_name(v)
+						for k, v in sorted(self.influx_safe_common_tags.items()) if v)
+			else:
+				self.influx_backoff()
+
+		# start new timers, even if we're disconnected, so points keep
+		# piling up in influx_pending until we're back
+		if self.influx_kwargs is not None:
+			self.influx_start_timers()
+
+	def influx_backoff(self):
+		# wait twice as long after each failure, with some jitter so we
+		# don't retry in lockstep with anything else
+		self.influx_reconnect_failures += 1
+		self.influx_last_reconnect = monotonic()
+		self.influx_reconnect_delay = min(MAX_RECONNECT_DELAY, 2 ** self.influx_reconnect_failures) * random.uniform(0.8, 1.2)
+
+		# nothing else is guaranteed to come along and retry, so schedule
+		# it ourselves
+		if self.influx_retry_timer:
+			self.influx_retry_timer.cancel()
+		self.influx_retry_timer = threading.Timer(self.influx_reconnect_delay, self.influx_reconnect, args=(True,))
+		self.influx_retry_timer.daemon = True
+		self.influx_retry_timer.start()
+
+	def _debounced_reconnect(self):
+		self.influx_settings_timer = None
+		settings_hash = self.influx_settings_hash(self.influx_build_kwargs())
+		if self.influx_db is None or settings_hash != self.influx_settings_hash_last:
+			self.influx_reconnect(True)
+		elif self.influx_timer_settings() != self.influx_timers_for:
+			# same connection, only the timers need to change
+			self.influx_start_timers()
 
 	# what are bad names for tags that we should change
 	influx_name_blacklist = set([
 		'time',
 	])
 
-	def influx_emit(self, measurement, fields, extra_tags={}):
-		tags = self.influx_common_tags.copy()
-		if extra_tags:
-			tags.update(extra_tags)
-
-		fields = fields.copy()
-
+	def influx_sanitize_names(self, d):
 		# make sure we don't use any keywords as names
-		for k in list(tags.keys()):
-			if k in self.influx_name_blacklist:
-				tags[k + '_'] = tags[k]
-				del tags[k]
-		for k, v in list(fields.items()):
-			# also, make sure we give influx only data it can handle
-			if not isinstance(v, ALLOWED_TYPES):
-				del fields[k]
-				continue
-			if k in self.influx_name_blacklist:
-				fields[k + '_'] = fields[k]
-				del fields[k]
+		# the blacklist is tiny, so look each one up rather than scanning d,
+		# and only copy d if something needs renaming
+		for k in self.influx_name_blacklist:
+			if k in d:
+				d = d.copy()
+				d[k + '_'] = d.pop(k)
+		return d
+
+	def influx_emit(self, measurement, fields, extra_tags={}, _safe=False):
+		# make sure we give influx only data it can handle
+		fields = {k: v for k, v in fields.items() if isinstance(v, ALLOWED_TYPES)}
+
+		# names we generate ourselves are already safe, but the rest
+		# may come from anywhere
+		tags = extra_tags
+		if not _safe:
+			tags = self.influx_sanitize_names(tags)
+			fields = self.influx_sanitize_names(fields)
 
 		# empty fields are an issue for influx, so
 		if not fields:
+			if not extra_tags:
+				# nothing here worth writing (say, temperatures that are
+				# all None), so don't bother
+				return
+			# events still mean something without any fields
 			fields['_dummy'] = 0
 
-		# python doesn't put the Z at the end
-		# because python cannot into timezones until Python 3
-		time = datetime.datetime.utcnow().isoformat() + 'Z'
-		point = {
-			'measurement': self.influx_prefix + measurement,
-			'tags': tags,
-			'time': time,
-			'fields': fields,
-		}
+		if self.influx_use_udp:
+			# skip the client entirely, and write line protocol ourselves
+			point = ''.join([
+				line_escape_measurement(self.influx_prefix + measurement),
+				self.influx_line_tags,
+				''.join(',' + line_escape_name(k) + '=' + line_escape_name(v) for k, v in sorted(tags.items()) if v),
+				' ',
+				','.join(line_escape_name(k) + '=' + line_format_value(v) for k, v in fields.items()),
+				' ',
+				str(time_ns()),
+			]).encode('utf-8')
+		else:
+			tags = dict(self.influx_safe_common_tags, **tags) if tags else self.influx_safe_common_tags
+			point = {
+				'measurement': self.influx_prefix + measurement,
+				'tags': tags,
+				'time': time_ns(),
+				'fields': fields,
+			}
+		# points are buffered and written in batches, see _flush_pending
+		with self.influx_pending_lock:
+			self.influx_pending.append(point)
+
+	def _flush_pending(self):
+		db = self.influx_db
+		if not db:
+			# hold onto the points until we reconnect
+			return
+		if monotonic() < self.influx_last_reconnect + self.influx_reconnect_delay:
+			# still backing off from the last failure
+			return
+
+		with self.influx_pending_lock:
+			points = list(self.influx_pending)
+			self.influx_pending.clear()
+			self.influx_last_flush = monotonic()
+		if not points:
+			return
+
 		try:
-			self.influx_db.write_points([point], retention_policy=self.influx_retention_policy)
-		except Exception:
-			# we were dropped! try to reconnect
+			if self.influx_use_udp:
+				self.influx_send_lines(points)
+			else:
+				db.write_points(points, time_precision='n', retention_policy=self.influx_retention_policy, batch_size=MAX_WRITE_BATCH)
+			self.influx_reconnect_failures = 0
+			self.influx_reconnect_delay = 0
+		except Exception as e:
+			client_error = isinstance(e, influxdb.exceptions.InfluxDBClientError)
+			# a 400 means the server didn't like the points themselves, and
+			# anything that isn't from the client or the network is our
+			# own doing, so neither will ever be accepted and retrying them
+			# would only hold everything else up
+			if (client_error and e.code == 400) or not (client_error or isinstance(e, (IOError, socket.error, influxdb.exceptions.InfluxDBServerError))):
+				self._logger.exception("InfluxDB rejected {0} points, dropping them.".format(len(points)))
+				return
+			if client_error:
+				# the database is gone, or our credentials are no good
+				# anymore, so check everything properly when we reconnect
+				self.influx_known_dbs.discard(self.influx_db_key(self.influx_kwargs))
+			# put the points back so a brief disconnect doesn't lose them
+			# (the deque drops the oldest points if it overflows)
+			with self.influx_pending_lock:
+				points.extend(self.influx_pending)
+				self.influx_pending.clear()
+				self.influx_pending.extend(points)
+			# we were dropped! try to reconnect, once we've waited a bit
 			self.influx_flash_exception("Disconnected from InfluxDB. Attempting to reconnect.")
 			self.influx_db = None
-			self.influx_reconnect()
+			self.influx_backoff()
+
+	def influx_send_lines(self, lines):
+		# pack as many lines as will fit into each packet
+		packet = []
+		size = 0
+		for line in lines:
+			if packet and size + len(line) + 1 > UDP_PACKET_SIZE:
+				self.influx_udp_socket.sendto(b'\n'.join(packet), self.influx_udp_address)
+				packet = []
+				size = 0
+			packet.append(line)
+			size += len(line) + 1
+		if packet:
+			self.influx_udp_socket.sendto(b'\n'.join(packet), self.influx_udp_address)
+
+	def influx_flush_if_needed(self):
+		# the flush timer handles flush_interval, but check here too in case
+		# a big burst of points fills up a batch before then
+		now = monotonic()
+		if len(self.influx_pending) >= self.influx_batch_size or self.influx_last_flush + self.influx_flush_interval <= now:
+			self._flush_pending()
 
 	def influx_gather(self):
-		# if we're not connected to a database, do nothing
-		if not self.influx_connected():
+		# try to reconnect if we need to, but keep gathering either way,
+		# unless we've never connected and don't know how to format points
+		self.influx_connected()
+		if self.influx_kwargs is None:
 			return
 		# if we're not connected to a printer, do nothing
 		if not self._printer.is_operational():
 			return
 
 		temps = self._printer.get_current_temperatures()
+		fields = {}
 		if temps:
-			fields = {}
-			for sensor in temps:
-				for subfield in temps[sensor]:
-					fields[sensor + '_' + subfield] = temps[sensor][subfield]
-
-			self.influx_emit('temperature', fields)
+			fields = self.influx_temperature_fields(temps)
+			self.influx_emit('temperature', fields, _safe=True)
+		self.influx_adapt_interval(fields)
 
 		data = self._printer.get_current_data()
-		def add_to(d, k, x):
-			if x:
-				d[k] = x
-
 		if data and data.get('progress'):
 			# a file is printing!
 			progress = data['progress']
-			fields = {}
-			add_to(fields, 'current_z', data.get('currentZ'))
 			# added in 1.x but probably should not exist
 			# it's an integer between 0 and 100!
 			pct = progress.get('completion')
 			if pct:
 				pct = int(round(pct))
-			add_to(fields, 'pct', pct)
-			# this is the version that should exist
-			# still 0-100 because octoprint likes that, but float
-			add_to(fields, 'completion', progress.get('completion'))
-			add_to(fields, 'filepos', progress.get('filepos'))
-			add_to(fields, 'print_time', progress.get('printTime'))
-			add_to(fields, 'print_time_left', progress.get('printTimeLeft'))
-			add_to(fields, 'print_time_left_origin', progress.get('printTimeLeftOrigin'))
+			# only keep the values that are set
+			fields = {k: v for k, v in (
+				('current_z', data.get('currentZ')),
+				('pct', pct),
+				# this is the version that should exist
+				# still 0-100 because octoprint likes that, but float
+				('completion', progress.get('completion')),
+				('filepos', progress.get('filepos')),
+				('print_time', progress.get('printTime')),
+				('print_time_left', progress.get('printTimeLeft')),
+				('print_time_left_origin', progress.get('printTimeLeftOrigin')),
+			) if v}
 			if fields:
-				self.influx_emit('progress', fields)
+				self.influx_emit('progress', fields, _safe=True)
+
+		self.influx_flush_if_needed()
+
+	def influx_temperature_fields(self, temps):
+		return {sensor + '_' + subfield: v for sensor, subfields in temps.items() for subfield, v in subfields.items()}
+
+	def influx_temps_steady(self):
+		if len(self.influx_recent_temps) < IDLE_SAMPLES:
+			return False
+		latest = self.influx_recent_temps[-1]
+		for sample in self.influx_recent_temps:
+			if sample.keys() != latest.keys():
+				return False
+			for k, v in sample.items():
+				if v is None or latest[k] is None:
+					if v is not latest[k]:
+						return False
+				elif abs(v - latest[k]) > IDLE_TOLERANCE:
+					return False
+		return True
+
+	def influx_adapt_interval(self, temps):
+		# gather less often while the printer is sitting idle, and go
+		# back to the usual interval as soon as anything happens
+		self.influx_recent_temps.append(temps)
+		if self._printer.is_printing() or not self.influx_temps_steady():
+			self.influx_gather_interval = self.influx_interval
+		else:
+			max_interval = max(self.influx_interval, self.influx_max_idle_interval)
+			self.influx_gather_interval = min(self.influx_gather_interval * 2, max_interval)
 
 	##~~ EventHandlerPlugin mixin
 
+	# events worth recording, leaving out the ones that fire constantly
+	# while printing (like ZChange and PositionUpdate)
+	influx_events = frozenset([
+		# server and connection
+		'Startup', 'Shutdown', 'Connecting', 'Connected', 'Disconnected',
+		'PrinterStateChanged', 'Error',
+		# printing
+		'PrintStarted', 'PrintFailed', 'PrintDone', 'PrintCancelling',
+		'PrintCancelled', 'PrintPaused', 'PrintResumed',
+		# printer communication
+		'Home', 'ToolChange', 'FilamentChange', 'Alert', 'EStop',
+		# files
+		'Upload', 'FileAdded', 'FileRemoved', 'FileSelected', 'FileDeselected',
+		'MetadataAnalysisStarted', 'MetadataAnalysisFinished',
+		# slicing
+		'SlicingStarted', 'SlicingDone', 'SlicingCancelled', 'SlicingFailed',
+		# timelapses
+		'MovieRendering', 'MovieDone', 'MovieFailed',
+	])
+
+	# events after which we should stop idling and gather at the usual rate
+	influx_active_events = frozenset([
+		'PrintStarted',
+		'PrintResumed',
+	])
+
+	# events after which the printer state may have changed
+	influx_state_events = frozenset([
+		'PrinterStateChanged',
+		'FileSelected',
+		'FileDeselected',
+		'MetadataAnalysisFinished',
+	])
+
 	def on_event(self, event, payload):
-		# if we're not connected, do nothing
-		if not self.influx_connected():
+		if event not in self.influx_events:
+			return
+		# same as in influx_gather
+		self.influx_connected()
+		if self.influx_kwargs is None:
 			return
 
 		if not payload:
 			payload = {}
 		self.influx_emit('events', payload, extra_tags={'type': event})
 
+		if event in self.influx_active_events and self.influx_gather_interval != self.influx_interval:
+			# don't wait out a long idle interval to start gathering again
+			self.influx_start_timers()
+
 		# state changes happen on events, so...
-		if event not in ['PrinterStateChanged', 'FileSelected', 'FileDeselected', 'MetadataAnalysisFinished']:
+		if event not in self.influx_state_events:
 			# state hasn't changed
 			return
 
 		job = self._printer.get_current_job()
 		data = self._printer.get_current_data()
-		def add_to(d, k, x):
-			if x:
-				d[k] = x
 
-		fields = {}
-		add_to(fields, 'state', data.get('state', {}).get('text'))
+		values = [('state', data.get('state', {}).get('text'))]
 		if job.get('file', {}).get('name'):
 			# a file is loaded...
 			jobfile = job['file']
-			add_to(fields, 'average_print_time', job.get('averagePrintTime'))
-			add_to(fields, 'estimated_print_time', job.get('estimatedPrintTime'))
+			values.extend([
+				('average_print_time', job.get('averagePrintTime')),
+				('estimated_print_time', job.get('estimatedPrintTime')),
+				('file_date', jobfile.get('date')),
+				('file', jobfile.get('display')),
+				('file_size', jobfile.get('size')),
+				('last_print_time', job.get('lastPrintTime')),
+				('user', job.get('user')),
+			])
 			filaments = job.get('filament')
 			if not filaments:
 				filaments = {}
 			for filname, filval in filaments.items():
-				add_to(fields, 'filament_' + filname + '_length', filval.get('length'))
-				add_to(fields, 'filament_' + filname + '_volume', filval.get('volume'))
-			add_to(fields, 'file_date', jobfile.get('date'))
-			add_to(fields, 'file', jobfile.get('display'))
-			add_to(fields, 'file_size', jobfile.get('size'))
-			add_to(fields, 'last_print_time', job.get('lastPrintTime'))
-			add_to(fields, 'user', job.get('user'))
+				values.append(('filament_' + filname + '_length', filval.get('length')))
+				values.append(('filament_' + filname + '_volume', filval.get('volume')))
+		# only keep the values that are set
+		fields = {k: v for k, v in values if v}
 		if fields:
-			self.influx_emit('state', fields)
+			self.influx_emit('state', fields, _safe=True)
 
 	##~~ SettingsPlugin mixin
 
@@ -308,22 +674,8 @@ class InfluxDBPlugin(octoprint.plugin.EventHandlerPlugin,
 		return 0
 
 	def get_settings_defaults(self):
-		return dict(
-			host=None,
-			port=None,
-			authenticate=False,
-			udp=False,
-			ssl=False,
-			verify_ssl=True,
-			database='octoprint',
-			prefix='',
-			hostmethod=HOST_NODE,
-			hostcustom='octoprint',
-			username=None,
-			password=None,
-			retention_policy=None,
-			interval=1,
-		)
+		# a copy, since the caller may modify it
+		return dict(SETTINGS_DEFAULTS)
 
 	def get_settings_restricted_paths(self):
 		return dict(admin=[
@@ -340,9 +692,29 @@ class InfluxDBPlugin(octoprint.plugin.EventHandlerPlugin,
 
 	def on_settings_save(self, data):
 		r = octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
-		self.influx_reconnect(True)
+		# wait for the settings to settle down before reconnecting
+		if self.influx_settings_timer:
+			self.influx_settings_timer.cancel()
+		self.influx_settings_timer = threading.Timer(SETTINGS_DEBOUNCE, self._debounced_reconnect)
+		self.influx_settings_timer.daemon = True
+		self.influx_settings_timer.start()
 		return r
 
+	##~~ ShutdownPlugin mixin
+
+	def on_shutdown(self):
+		self.influx_shutting_down = True
+		for timer in (self.influx_settings_timer, self.influx_retry_timer):
+			if timer:
+				timer.cancel()
+		self.influx_stop_timers()
+		# write out whatever is still waiting, but don't hold up the
+		# shutdown for long if the server isn't answering
+		flush = threading.Thread(target=self._flush_pending)
+		flush.daemon = True
+		flush.start()
+		flush.join(SHUTDOWN_FLUSH_TIMEOUT)
+
 	##~~ StartupPlugin mixin
 
 	def on_after_startup(self):